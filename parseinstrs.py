@@ -1,27 +1,42 @@
 #!/usr/bin/python3
 
 import argparse
-from binascii import unhexlify
-from collections import OrderedDict, defaultdict, namedtuple, Counter
-from copy import copy
-from enum import Enum, IntEnum
+from collections import OrderedDict
+from enum import Enum
+from functools import lru_cache
 from itertools import accumulate, product
 import struct
-from typing import NamedTuple, FrozenSet, List, Tuple, Union, Optional, ByteString
+from typing import NamedTuple, FrozenSet, Tuple, Union, Optional
 
 def bitstruct(name, fields):
     names, sizes = zip(*(field.split(":") for field in fields))
     sizes = tuple(map(int, sizes))
     offsets = (0,) + tuple(accumulate(sizes))
+    # (index, mask, shift) per field, so that _encode avoids attribute lookups.
+    spec = tuple((i, (1 << size) - 1, offset)
+                 for i, (size, offset) in enumerate(zip(sizes, offsets)))
     class __class:
+        __slots__ = ("_vals",)
         def __init__(self, **kwargs):
-            for name in names:
-                setattr(self, name, kwargs.get(name, 0))
+            self._vals = [kwargs.get(name, 0) for name in names]
+        def copy(self):
+            res = object.__new__(type(self))
+            res._vals = self._vals[:]
+            return res
         def _encode(self, length):
             enc = 0
-            for name, size, offset in zip(names, sizes, offsets):
-                enc += (getattr(self, name) & ((1 << size) - 1)) << offset
+            vals = self._vals
+            for i, mask, shift in spec:
+                enc |= (vals[i] & mask) << shift
             return enc.to_bytes(length, "little")
+    def field(idx):
+        def fget(self):
+            return self._vals[idx]
+        def fset(self, value):
+            self._vals[idx] = value
+        return property(fget, fset)
+    for i, field_name in enumerate(names):
+        setattr(__class, field_name, field(i))
     __class.__name__ = name
     return __class
 
@@ -142,28 +157,40 @@ class InstrDesc(NamedTuple):
     }
 
     @classmethod
+    @lru_cache(maxsize=None) # Identical descriptions recur across opcodes.
     def parse(cls, desc):
         desc = desc.split()
         operands = tuple(OPKINDS[op] for op in desc[1:5] if op != "-")
         return cls(desc[5], desc[0], operands, frozenset(desc[6:]))
 
+    @lru_cache(maxsize=None) # Called for every mode and trie path.
     def encode(self):
-        flags = copy(ENCODINGS[self.encoding])
-
-        opsz = set(self.OPKIND_SIZES[opkind.size] for opkind in self.operands)
-
-        # Sort fixed sizes encodable in size_fix2 as second element.
-        fixed = sorted((x for x in opsz if x >= 0), key=lambda x: 1 <= x <= 4)
-        if len(fixed) > 2 or (len(fixed) == 2 and not (1 <= fixed[1] <= 4)):
+        flags = ENCODINGS[self.encoding].copy()
+
+        # Bitmap of fixed sizes (log2), the variable sizes -2/-3 are ignored.
+        opsz = 0
+        for opkind in self.operands:
+            opsz |= 1 << (self.OPKIND_SIZES[opkind.size] + 3)
+        opsz >>= 3
+
+        # Sort fixed sizes encodable in size_fix2 (1-4, 0x1e) as second element.
+        fixed = []
+        for group in (opsz & 0x61, opsz & 0x1e):
+            while group:
+                lowest = group & -group
+                fixed.append(lowest.bit_length() - 1)
+                group ^= lowest
+        if len(fixed) > 2 or (len(fixed) == 2 and not opsz & 0x1e):
             raise Exception("invalid fixed operand sizes: %r"%fixed)
         sizes = (fixed + [1, 1])[:2] + [-2, -3] # See operand_sizes in decode.c.
         flags.size_fix1 = sizes[0]
         flags.size_fix2 = sizes[1] - 1
+        size_idx = {sz: i for i, sz in reversed(tuple(enumerate(sizes)))}
 
         for i, opkind in enumerate(self.operands):
             sz = self.OPKIND_SIZES[opkind.size]
             reg_type = self.OPKIND_REGTYS.get(opkind.kind, 7)
-            setattr(flags, "op%d_size"%i, sizes.index(sz))
+            setattr(flags, "op%d_size"%i, size_idx[sz])
             if i < 3:
                 setattr(flags, "op%d_regty"%i, reg_type)
             elif reg_type not in (7, 2):
@@ -182,8 +209,7 @@ class InstrDesc(NamedTuple):
                 (imm_op.size == OpKind.SZ_OP and flags.size8)):
                 flags.imm_control |= 1
 
-        enc = flags._encode(6)
-        enc = tuple(int.from_bytes(enc[i:i+2], "little") for i in range(0, 6, 2))
+        enc = struct.unpack("<3H", flags._encode(6))
         # First 2 bytes are the mnemonic, last 6 bytes are the encoding.
         return ("FDI_"+self.mnemonic,) + enc
 
@@ -212,9 +238,10 @@ class TrieEntry(NamedTuple):
         EntryKind.TABLE_PREFIX_REP: 4,
         EntryKind.TABLE_ROOT: 8,
     }
+    EMPTY_ITEMS = {kind: (None,) * length for kind, length in TABLE_LENGTH.items()}
     @classmethod
     def table(cls, kind):
-        return cls(kind, (None,) * cls.TABLE_LENGTH[kind], ())
+        return cls(kind, cls.EMPTY_ITEMS[kind], ())
     @classmethod
     def instr(cls, payload):
         return cls(EntryKind.INSTR, (), payload)
@@ -229,10 +256,17 @@ class TrieEntry(NamedTuple):
     def map(self, map_func):
         mapped_items = (map_func(i, v) for i, v in enumerate(self.items))
         return TrieEntry(self.kind, tuple(mapped_items), self.payload)
+    def remap(self, names):
+        items = tuple(names.get(v, v) for v in self.items)
+        return self._replace(items=items)
     def update(self, idx, new_val):
-        return self.map(lambda i, v: new_val if i == idx else v)
+        items = self.items[:idx] + (new_val,) + self.items[idx+1:]
+        return self._replace(items=items)
 
-import re
+try:
+    import re2 as re # DFA-based, the opcode grammar needs no backtracking.
+except ImportError:
+    import re
 opcode_regex = re.compile(
     r"^(?:(?P<prefixes>(?P<vex>VEX\.)?(?P<legacy>NP|66|F2|F3)\." +
                      r"(?:W(?P<rexw>[01]|IG)\.)?(?:L(?P<vexl>[01]|IG)\.)?)" +
@@ -240,6 +274,11 @@ opcode_regex = re.compile(
      r"(?P<opcode>(?:[0-9a-f]{2})+)" +
      r"(?P<modrm>//?[0-7]|//[c-f][0-9a-f])?" +
      r"(?P<extended>\+)?$")
+OPCODE_GROUPS = opcode_regex.groupindex
+GRP_VEX, GRP_LEGACY, GRP_REXW, GRP_VEXL, GRP_REPPREFIX = (OPCODE_GROUPS[k]
+    for k in ("vex", "legacy", "rexw", "vexl", "repprefix"))
+GRP_OPCODE, GRP_MODRM, GRP_EXTENDED = (OPCODE_GROUPS[k]
+    for k in ("opcode", "modrm", "extended"))
 
 class Opcode(NamedTuple):
     prefix: Union[None, Tuple[bool, str]] # (False, NP/66/F2/F3), (True, NP/F2/F3)
@@ -252,33 +291,36 @@ class Opcode(NamedTuple):
     rexw: Union[str, None] # 0, 1, IG, None = used, both
 
     @classmethod
+    @lru_cache(maxsize=None) # Opcodes recur, e.g. with ONLY32/ONLY64 variants.
     def parse(cls, opcode_string):
         match = opcode_regex.match(opcode_string)
         if match is None:
             return None
 
-        opcext = match.group("modrm")
+        opcext = match.group(GRP_MODRM)
         if opcext:
             is72 = opcext[1] == "/"
             opcext = is72, int(opcext[1 + is72:], 16)
 
-        if match.group("extended") and opcext and not opcext[0]:
+        extended = match.group(GRP_EXTENDED) is not None
+        if extended and opcext and not opcext[0]:
             raise Exception("invalid opcode extension: {}".format(opcode_string))
 
-        prefix_strs = match.group("legacy"), match.group("repprefix")
+        prefix_strs = match.group(GRP_LEGACY, GRP_REPPREFIX)
         prefix = prefix_strs[0] or prefix_strs[1]
         if prefix:
-            prefix = prefix_strs[1] is not None, ["NP", "66", "F3", "F2"].index(prefix)
+            prefix = prefix_strs[1] is not None, OPCODE_PREFIXES.index(prefix)
 
+        opcode = match.group(GRP_OPCODE)
         return cls(
             prefix=prefix,
-            escape=["", "0f", "0f38", "0f3a"].index(match.group("opcode")[:-2]),
-            opc=int(match.group("opcode")[-2:], 16),
+            escape=OPCODE_ESCAPES.index(opcode[:-2]),
+            opc=int(opcode[-2:], 16),
             opcext=opcext,
-            extended=match.group("extended") is not None,
-            vex=match.group("vex") is not None,
-            vexl=match.group("vexl"),
-            rexw=match.group("rexw"),
+            extended=extended,
+            vex=match.group(GRP_VEX) is not None,
+            vexl=match.group(GRP_VEXL),
+            rexw=match.group(GRP_REXW),
         )
 
     def for_trie(self):
@@ -303,108 +345,150 @@ class Opcode(NamedTuple):
             opcode.append((EntryKind.TABLE_VEX, entries))
 
         kinds, values = zip(*opcode)
+        if all(len(v) == 1 for v in values): # Common case, nothing to expand.
+            return [tuple((kind, v[0]) for kind, v in opcode)]
         return [tuple(zip(kinds, prod)) for prod in product(*values)]
 
+OPCODE_ESCAPES = ("", "0f", "0f38", "0f3a")
+OPCODE_PREFIXES = ("NP", "66", "F3", "F2")
+OPCODE_PREFIXES_REP = ("RNP.", "??.", "RF3.", "RF2.")
+
+# Mapping from kind to function returning (prefix, opcode) strings for a byte.
+OPCODE_FORMATTERS = {
+    EntryKind.TABLE_ROOT: lambda byte: (("", "VEX.")[byte >> 2],
+                                        OPCODE_ESCAPES[byte & 3]),
+    EntryKind.TABLE256: lambda byte: ("", "{:02x}".format(byte)),
+    EntryKind.TABLE8: lambda byte: ("", "/{:x}".format(byte)),
+    EntryKind.TABLE72: lambda byte: ("", "/{:x}".format(byte)),
+    EntryKind.TABLE_PREFIX: lambda byte: (("VEX." if byte & 4 else "") +
+                                          OPCODE_PREFIXES[byte & 3] + ".", ""),
+    EntryKind.TABLE_PREFIX_REP: lambda byte: (OPCODE_PREFIXES_REP[byte & 3], ""),
+    EntryKind.TABLE_VEX: lambda byte: ("W{}.L{}.".format(byte & 1, byte >> 1), ""),
+}
+
 def format_opcode(opcode):
-    opcode_string = ""
-    prefix = ""
+    prefix, opcode_string = [], []
     for kind, byte in opcode:
-        if kind == EntryKind.TABLE_ROOT:
-            opcode_string += ["", "0f", "0f38", "0f3a"][byte & 3]
-            prefix += ["", "VEX."][byte >> 2]
-        elif kind == EntryKind.TABLE256:
-            opcode_string += "{:02x}".format(byte)
-        elif kind in (EntryKind.TABLE8, EntryKind.TABLE72):
-            opcode_string += "/{:x}".format(byte)
-        elif kind == EntryKind.TABLE_PREFIX:
-            if byte & 4:
-                prefix += "VEX."
-            prefix += ["NP.", "66.", "F3.", "F2."][byte&3]
-        elif kind == EntryKind.TABLE_PREFIX_REP:
-            prefix += ["RNP.", "??.", "RF3.", "RF2."][byte&3]
-        elif kind == EntryKind.TABLE_VEX:
-            prefix += "W{}.L{}.".format(byte & 1, byte >> 1)
-        else:
+        formatter = OPCODE_FORMATTERS.get(kind)
+        if formatter is None:
             raise Exception("unsupported opcode kind {}".format(kind))
-    return prefix + opcode_string
+        prefix_part, opcode_part = formatter(byte)
+        prefix.append(prefix_part)
+        opcode_string.append(opcode_part)
+    return "".join(prefix) + "".join(opcode_string)
 
 class Table:
     def __init__(self, root_count=1):
         self.data = OrderedDict()
-        self.roots = ["root%d"%i for i in range(root_count)]
-        for i in range(root_count):
-            self.data["root%d"%i] = TrieEntry.table(EntryKind.TABLE_ROOT)
+        # Entries are named by (root index, opcode path), the roots by an
+        # empty opcode path.
+        self.roots = [(i, ()) for i in range(root_count)]
+        for root in self.roots:
+            self.data[root] = TrieEntry.table(EntryKind.TABLE_ROOT)
         self.offsets = {}
         self.annotations = {}
 
+    @staticmethod
+    def format_name(name):
+        root_idx, opcode = name
+        if not opcode:
+            return "root%d"%root_idx
+        return "t{},{}".format(root_idx, format_opcode(opcode))
+
     def _update_table(self, name, idx, entry_name, entry_val):
         # Don't override existing entries. This only happens on invalid input,
         # e.g. when an opcode is specified twice.
         if self.data[name].items[idx]:
-            raise Exception("{}/{} set, not overriding to {}".format(name, idx, entry_name))
+            raise Exception("{}/{} set, not overriding to {}".format(
+                            self.format_name(name), idx, self.format_name(entry_name)))
         self.data[entry_name] = entry_val
         self.data[name] = self.data[name].update(idx, entry_name)
 
     def add_opcode(self, opcode, instr_encoding, root_idx=0):
-        name = "t{},{}".format(root_idx, format_opcode(opcode))
+        name = root_idx, opcode
 
-        tn = "root%d"%root_idx
+        tn = self.roots[root_idx]
         for i in range(len(opcode) - 1):
             # kind is the table kind that we want to point to in the _next_.
             kind, byte = opcode[i+1][0], opcode[i][1]
             # Retain prev_tn name so that we can update it.
             prev_tn, tn = tn, self.data[tn].items[byte]
             if tn is None:
-                tn = "t{},{}".format(root_idx, format_opcode(opcode[:i+1]))
+                tn = root_idx, opcode[:i+1]
                 self._update_table(prev_tn, byte, tn, TrieEntry.table(kind))
 
             if self.data[tn].kind != kind:
                 raise Exception("{}, have {}, want {}".format(
-                                name, self.data[tn].kind, kind))
+                                self.format_name(name), self.data[tn].kind, kind))
 
         self._update_table(tn, opcode[-1][1], name, TrieEntry.instr(instr_encoding))
 
     def deduplicate(self):
-        synonyms = True
-        while synonyms:
-            entries = {} # Mapping from entry to name
-            synonyms = {} # Mapping from name to unique name
-            for name, entry in self.data.items():
-                if entry in entries:
-                    synonyms[name] = entries[entry]
-                else:
-                    entries[entry] = name
-            for name, entry in self.data.items():
-                self.data[name] = entry.map(lambda _, v: synonyms.get(v, v))
-            for key in synonyms:
-                del self.data[key]
+        # Structural hashing in post-order: children are classified before
+        # their parents, so a single pass reaches the fixed point.
+        postorder = []
+        visited = set()
+        stack = [(root, False) for root in reversed(self.roots)]
+        while stack:
+            name, expanded = stack.pop()
+            if expanded:
+                postorder.append(name)
+            elif name not in visited:
+                visited.add(name)
+                stack.append((name, True))
+                stack.extend((item, False) for item in self.data[name].items if item)
+
+        classes = {} # Mapping from entry (with classified children) to class
+        class_of = {} # Mapping from name to class
+        for name in postorder:
+            entry = self.data[name].remap(class_of)
+            class_of[name] = classes.setdefault(entry, name)
+
+        # Retain the first name of each class in table order.
+        canonical = {}
+        for name in self.data:
+            canonical.setdefault(class_of[name], name)
+        synonyms = {name: canonical[cls] for name, cls in class_of.items()}
+        for name, entry in list(self.data.items()):
+            if synonyms[name] != name:
+                del self.data[name]
+            else:
+                self.data[name] = entry.remap(synonyms)
 
     def calc_offsets(self):
         current = 0
         for name, entry in self.data.items():
-            self.annotations[current] = "%s(%d)" % (name, entry.kind.value)
+            self.annotations[current] = "%s(%d)" % (self.format_name(name), entry.kind.value)
             self.offsets[name] = current
             current += (entry.encode_length + 3) & ~3
         if current >= 0x8000:
             raise Exception("maximum table size exceeded: {:x}".format(current))
 
-    def encode_item(self, name):
-        return (self.offsets[name] << 1) | self.data[name].kind.value
-
     def compile(self):
         self.calc_offsets()
         ordered = sorted((off, self.data[k]) for k, off in self.offsets.items())
+        # Pack each entry reference once instead of for every referrer.
+        packed = {name: (off << 1) | self.data[name].kind.value
+                  for name, off in self.offsets.items()}
 
-        data = ()
+        last_off, last_entry = ordered[-1]
+        data = [0] * (last_off + last_entry.encode_length)
         for off, entry in ordered:
-            data += (0,) * (off - len(data)) + entry.encode(self.encode_item)
+            enc = entry.encode(packed.__getitem__)
+            data[off:off+len(enc)] = enc
 
-        stats = dict(Counter(entry.kind for entry in self.data.values()))
+        stats = {}
+        for entry in self.data.values():
+            stats[entry.kind] = stats.get(entry.kind, 0) + 1
         print("%d bytes" % (2*len(data)), stats)
         return data, self.annotations, [self.offsets[k] for k in self.roots]
 
+@lru_cache(maxsize=None) # Words repeat a lot, e.g. padding and shared flags.
+def format_table_word(value):
+    return "%#04x,"%value
+
 def bytes_to_table(data, notes):
-    strdata = tuple(d+"," if type(d) == str else "%#04x,"%d for d in data)
+    strdata = [d+"," if type(d) == str else format_table_word(d) for d in data]
     offs = [0] + sorted(notes.keys()) + [len(data)]
     return "\n".join("".join(strdata[p:c]) + "\n//%04x "%c + notes.get(c, "")
                      for p, c in zip(offs, offs[1:]))
@@ -433,9 +517,10 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     entries = []
-    for line in args.table.read().splitlines():
+    for line in args.table:
+        line = line.rstrip("\n")
         if not line or line[0] == "#": continue
-        opcode_string, desc = tuple(line.split(maxsplit=1))
+        opcode_string, _, desc = line.partition(" ")
         entries.append((Opcode.parse(opcode_string), InstrDesc.parse(desc)))
 
     mnemonics = sorted({desc.mnemonic for _, desc in entries})